@@ -1,14 +1,29 @@
 import argparse
+import importlib.util
 import os
+import random
+import time
 import traceback
 
+# Use the Rust multi-part downloader when available (pip install hf_transfer).
+# Must be set before huggingface_hub is imported.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 from huggingface_hub import login, snapshot_download
+from huggingface_hub.utils import (
+    GatedRepoError,
+    HfHubHTTPError,
+    RepositoryNotFoundError,
+    RevisionNotFoundError,
+)
 from tqdm import tqdm
 
 
 def download_data(
     huggingface_path, local_path, cache_dir, allow_patterns=None, max_workers=8
 ):
+    delay = 1.0
     while True:
         try:
             snapshot_download(
@@ -19,12 +34,17 @@ def download_data(
                 local_dir_use_symlinks=True,
                 allow_patterns=allow_patterns,
                 max_workers=max_workers,
+                etag_timeout=30,
             )
             break
-        except KeyboardInterrupt:
-            break
-        except:
+        except (RepositoryNotFoundError, GatedRepoError, RevisionNotFoundError):
+            # Bad repo id / revision or missing access: retrying won't help
+            raise
+        except (HfHubHTTPError, OSError):
             traceback.print_exc()
+            # Back off with jitter so transient 429s/resets don't hammer the hub
+            time.sleep(delay + random.random())
+            delay = min(delay * 2, 60)
             continue
 
 
@@ -1,35 +1,55 @@
 import argparse
+import importlib.util
 import os
+import random
+import time
 import traceback
 
+# Use the Rust multi-part downloader when available (pip install hf_transfer).
+# Must be set before huggingface_hub is imported.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 from huggingface_hub import login, snapshot_download
-from tqdm import tqdm
+from huggingface_hub.utils import (
+    GatedRepoError,
+    HfHubHTTPError,
+    RepositoryNotFoundError,
+    RevisionNotFoundError,
+)
 
 
-def download_model(huggingface_path, local_path, max_workers=8):
+def download_model(huggingface_path, local_path, cache_dir=None, max_workers=8):
+    delay = 1.0
     while True:
         try:
             snapshot_download(
                 huggingface_path,
                 local_dir=local_path,
+                cache_dir=cache_dir,
+                repo_type="model",
                 local_dir_use_symlinks=True,
+                max_workers=max_workers,
+                etag_timeout=30,
             )
             break
-        except KeyboardInterrupt:
-            break
-        except:
+        except (RepositoryNotFoundError, GatedRepoError, RevisionNotFoundError):
+            # Bad repo id / revision or missing access: retrying won't help
+            raise
+        except (HfHubHTTPError, OSError):
             traceback.print_exc()
+            # Back off with jitter so transient 429s/resets don't hammer the hub
+            time.sleep(delay + random.random())
+            delay = min(delay * 2, 60)
             continue
 
-    pass
-
 
 if __name__ == "__main__":
     token = os.getenv("HF_TOKEN")
     if token:
         login(token=token)
 
-    parser = argparse.ArgumentParser(description="Download HF dataset")
+    parser = argparse.ArgumentParser(description="Download HF model")
     parser.add_argument("--model", required=True)
     parser.add_argument("--loc", required=True)
     parser.add_argument("--max-workers", type=int)
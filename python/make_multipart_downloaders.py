@@ -1,10 +1,11 @@
 """ One-off script for jiacheng to make a bunch of S5CMD run scripts that:
 	- take an input directory on s3
-	- collect all files and shuffles them 
-	- creates output scripts that have total max_size < LIMIT 
+	- collect all files and pack them (largest first) into as few groups as possible
+	- creates output scripts (in shuffled order) that have total max_size < LIMIT 
 """
 
 import fcntl
+import heapq
 import io
 import os
 import random
@@ -34,26 +35,35 @@ def cli():
 @click.option("--remote-dst", required=True)
 @click.option("--script-output", required=True)
 @click.option("--limit", required=True)
-def make_download_scripts(s3_src, remote_dst, script_output, limit):
+@click.option("--concurrency", type=int, default=s5cmd.DEFAULT_CONCURRENCY)
+@click.option("--part-size", type=int, default=s5cmd.DEFAULT_PART_SIZE)  # in MB
+def make_download_scripts(
+    s3_src, remote_dst, script_output, limit, concurrency, part_size
+):
     files = s5cmd.S5CMD().ls(os.path.join(s3_src, "*"))
-    random.shuffle(files)
 
+    # Decreasing-size bin packing: place each file into the bin with the most
+    # room left (max-heap on remaining capacity), opening a new bin if none fits
+    files.sort(key=lambda d: -d["size"])
     groups = []
-    cur_size = 0
-    cur_group = []
+    bins = []  # (-remaining, group_idx)
     limit = int(limit)
     for el in files:
-        if cur_size + el["size"] > limit:
-            groups.append(cur_group)
-            cur_group = []
-            cur_size = 0
-        cur_group.append(el)
-        cur_size += el["size"]
-    groups.append(cur_group)
+        if bins and -bins[0][0] >= el["size"]:
+            neg_remaining, idx = heapq.heappop(bins)
+            groups[idx].append(el)
+            heapq.heappush(bins, (neg_remaining + el["size"], idx))
+        else:
+            groups.append([el])
+            heapq.heappush(bins, (el["size"] - limit, len(groups) - 1))
+    random.shuffle(groups)
 
     os.makedirs(script_output, exist_ok=True)
 
-    line_getter = lambda d: "cp %s %s" % (
+    # Multipart GETs per object: one cp stream per file leaves bandwidth unused
+    line_getter = lambda d: "cp --concurrency %s --part-size %s %s %s" % (
+        concurrency,
+        part_size,
         d["name"],
         os.path.join(remote_dst, d["name"].replace(s3_src, "").lstrip("/")),
     )
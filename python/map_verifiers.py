@@ -3,6 +3,9 @@ Some python code to make sure things that we need for running a map command
 
 """
 
+import functools
+import os
+
 import click
 import fasttext
 import yaml
@@ -18,26 +21,33 @@ def cli():
 # ===================================================================
 
 
-def check_url_substring_filter(kwargs):
-    banlist_file = kwargs["banlist_file"]
+@functools.lru_cache(maxsize=None)
+def _load_ft(path):
+    # Same model is often referenced by several steps (e.g. annotator + madlad400)
+    return fasttext.load_model(path)
+
+
+def _check_nonempty_file(path, desc):
+    # Stat instead of reading: banlists can be large
     try:
-        open(banlist_file, "r").read()
-    except:
-        raise Exception("Could not find banlist file: %s" % banlist_file)
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+    except OSError:
+        size = 0
+    if size == 0:
+        raise Exception("Could not find %s: %s" % (desc, path))
+
+
+def check_url_substring_filter(kwargs):
+    _check_nonempty_file(kwargs["banlist_file"], "banlist file")
 
 
 def check_fasttext_annotator(kwargs):
-    fasttext.load_model(kwargs["fast_text_file"])
+    _load_ft(kwargs["fast_text_file"])
 
 
 def check_madlad400(kwargs):
-    fasttext.load_model(kwargs["fast_text_file"])
-    try:
-        open(kwargs["cursed_regex_file"], "r").read()
-    except:
-        raise Exception(
-            "Could not find cursed regex file: %s" % kwargs["cursed_regex_file"]
-        )
+    _load_ft(kwargs["fast_text_file"])
+    _check_nonempty_file(kwargs["cursed_regex_file"], "cursed regex file")
 
 
 # ===================================================================
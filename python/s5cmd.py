@@ -1,18 +1,32 @@
 import fcntl
-import io
+import fnmatch
+import glob
+import gzip
+import heapq
+import importlib.util
+import itertools
+import json
 import os
 import re
-import select
+import shlex
+import sqlite3
 import subprocess
 import sys
 import threading
 import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
-from tempfile import NamedTemporaryFile
-from typing import Callable, Dict, List, Optional, Tuple, Union
+from tempfile import TemporaryDirectory, TemporaryFile, mkstemp
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import boto3
 import click
+from boto3.exceptions import Boto3Error
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
 from tqdm.auto import tqdm
 
 
@@ -26,13 +40,6 @@ def cli():
 # =====================================================
 
 
-def set_non_blocking(file_obj):
-    """Set file object to non-blocking mode"""
-    fd = file_obj.fileno()
-    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
-
 def weka_endpoint_args(weka_profile=None):
     if weka_profile == None:
         weka_profile = "WEKA"
@@ -49,6 +56,34 @@ def gs_endpoint_args(gs_profile=None):
     return cmd_str.split(" ")
 
 
+def _remote_endpoint(uri, weka_profile=None, gs_profile=None):
+    # weka:// and gs:// are s3:// to s5cmd, plus a profile and endpoint
+    if uri.startswith("weka://"):
+        return uri.replace("weka://", "s3://", 1), weka_endpoint_args(weka_profile)
+    if uri.startswith("gs://"):
+        return uri.replace("gs://", "s3://", 1), gs_endpoint_args(gs_profile)
+    return uri, []
+
+
+def _numworkers_args(numworkers=None):
+    # Global flag: has to come before the subcommand
+    return [] if numworkers is None else ["--numworkers", str(numworkers)]
+
+
+# Default s5cmd cp multipart tuning (--concurrency parts of --part-size MB each)
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PART_SIZE = 16
+
+
+def _multipart_args(concurrency=None, part_size=None):
+    args = []
+    if concurrency is not None:
+        args.extend(["--concurrency", str(concurrency)])
+    if part_size is not None:
+        args.extend(["--part-size", str(part_size)])
+    return args
+
+
 class S5CMD:
     """
     Python bindings for s5cmd
@@ -88,6 +123,10 @@ class S5CMD:
         exclude: Optional[str] = None,
         weka_profile: Optional[str] = None,
         gs_profile: Optional[str] = None,
+        numworkers: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        part_size: Optional[int] = None,
+        dry_run: bool = False,
     ) -> int:
         """
         Copy files from source to destination
@@ -98,97 +137,73 @@ class S5CMD:
             show_progress: Whether to show progress bar (overrides instance setting)
             include: Include pattern
             exclude: Exclude pattern
+            numworkers: Size of s5cmd's global worker pool
+            concurrency: Parts transferred in parallel per object
+            part_size: Multipart chunk size (in MB)
+            dry_run: Only print the resolved command, don't run it
 
         Returns:
             Return code from s5cmd
         """
 
         # Build command
-        cmd = [self.binary_path, "cp", "-sp"]
+        cmd = [self.binary_path] + _numworkers_args(numworkers)
+        cp_args = ["cp", "-sp"] + _multipart_args(concurrency, part_size)
 
         if include:
-            cmd.extend(["--include", include])
+            cp_args.extend(["--include", include])
 
         if exclude:
-            cmd.extend(["--exclude", exclude])
+            cp_args.extend(["--exclude", exclude])
 
-        if any("weka://" in [source, destination]):
+        if any("weka://" in _ for _ in [source, destination]):
             cmd.extend(weka_endpoint_args(weka_profile))
             source = source.replace("weka://", "s3://")
             destination = destination.replace("weka://", "s3://")
 
-        if any("gs://" in [source, destination]):
+        if any("gs://" in _ for _ in [source, destination]):
             cmd.extend(gs_endpoint_args(gs_profile))
             source = source.replace("gs://", "s3://")
             destination = destination.replace("gs://", "s3://")
 
         assert not all(
-            "s3://" in [source, destination]
+            "s3://" in _ for _ in [source, destination]
         ), "Only s3/weka<->local permitted!"
 
-        # some checks:
-
+        cmd.extend(cp_args)
         cmd.extend([source, destination])
 
+        if dry_run:
+            print("command:", shlex.join(cmd))
+            return 0
+
         pbar = tqdm(
             total=100, unit="%", bar_format="{l_bar}{bar}| {n:.2f}/{total}% {postfix}"
         )
 
-        # Execute command
+        def on_line(line):
+            if line.strip():
+                self._update_cp_progress_bar(pbar, line.strip().split())
+
+        return self._stream_output(cmd, on_line)
+
+    @contextmanager
+    def _spawn(self, cmd):
+        """
+        Start an s5cmd command with stdout+stderr merged into one text-mode,
+        line-buffered pipe, and make sure it is cleaned up on exit
+        """
         process = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             universal_newlines=True,  # text mode
-            bufsize=0,  # Unbuffered
+            bufsize=1,  # Line buffered
         )
-
-        set_non_blocking(process.stdout)
-
-        # Process output with poll/select mechanism
         try:
-            running = True
-            poller = select.poll()
-            poller.register(process.stdout, select.POLLIN)
-            while running:
-                # Wait for data (100ms timeout)
-                if poller.poll(100):
-                    try:
-                        data = process.stdout.read()
-                        if not data:
-                            # End of stream
-                            if process.poll() is not None:
-                                running = False
-                                continue
-                        if not data.strip():
-                            continue
-                        self._update_cp_progress_bar(pbar, data.strip().split())
-
-                    except io.BlockingIOError:
-                        # No data available right now
-                        pass
-                # Check if process has finished
-                if process.poll() is not None:
-                    running = False
-
-            # Wait for process to complete
-            return_code = process.wait()
-            return return_code
-
-        except KeyboardInterrupt:
-            # Try to gracefully terminate the process
-            process.terminate()
-            try:
-                process.wait(timeout=2)
-            except subprocess.TimeoutExpired:
-                process.kill()
-
-            if progress_bar:
-                progress_bar.finish()
-
-            raise
+            yield process
         finally:
-            # Make sure we clean up the process
+            # Make sure we clean up the process (e.g. on KeyboardInterrupt)
             if process.poll() is None:
                 try:
                     process.terminate()
@@ -199,10 +214,26 @@ class S5CMD:
                     except OSError:
                         pass
 
+    def _stream_output(self, cmd, on_line: Callable[[str], None]) -> int:
+        """
+        Run an s5cmd command, calling on_line for every line of its output
+
+        Lines are read with blocking readline() on the (text-mode, line-buffered)
+        pipe, so callbacks only ever see complete lines. Text mode also maps the
+        progress bar's carriage returns to line breaks.
+
+        Returns:
+            Return code from s5cmd
+        """
+        with self._spawn(cmd) as process:
+            for line in iter(process.stdout.readline, ""):
+                on_line(line)
+            return process.wait()
+
     @classmethod
     def _update_cp_progress_bar(cls, pbar, datasplit):
         pct = datasplit[0]
-        if "?" in pct:
+        if "?" in pct or not pct.endswith("%"):
             return
         postfix = " ".join(datasplit[2:])
         pct = float(pct.replace("%", ""))
@@ -226,6 +257,15 @@ class S5CMD:
         Returns:
             List of objects/files with their details
         """
+        return list(self.iter_ls(path, recursive, weka_profile, gs_profile))
+
+    def iter_ls(
+        self, path: str, recursive: bool = False, weka_profile=None, gs_profile=None
+    ) -> Iterator[Dict]:
+        """
+        Same as ls, but yields objects as s5cmd prints them instead of
+        collecting the whole listing in memory
+        """
         cmd = [self.binary_path]
 
         if recursive:
@@ -240,119 +280,258 @@ class S5CMD:
 
         cmd.append("ls")
         cmd.append(path)
-        print("RUNNING", " ".join(cmd))
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        print("RUNNING", " ".join(cmd), file=sys.stderr)
+        # stderr goes to a temp file, not a pipe: a pipe nobody reads until
+        # stdout hits EOF deadlocks once s5cmd fills it (e.g. per-key ERRORs)
+        stderr = TemporaryFile("w+")
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=stderr, text=True
+        )
 
         # Parse the output
-        files = []
         while os.path.basename(path) and "*" in os.path.basename(path):
             path = os.path.dirname(path)
 
-        for line in result.stdout.strip().split("\n"):
-            if not line:
-                continue
-
-            parts = line.split()
-            if len(parts) >= 4:  # Date Size Time Filename
-                size = int(parts[2])
-                filename = " ".join(parts[3:])
-                files.append(
-                    {
+        try:
+            for line in process.stdout:
+                parts = line.split()
+                if len(parts) >= 4:  # Date Size Time Filename
+                    size = int(parts[2])
+                    filename = " ".join(parts[3:])
+                    yield {
                         "ts": datetime.strptime(
                             f"{parts[0]} {parts[1]}", "%Y/%m/%d %H:%M:%S"
                         ).isoformat(),
                         "size": size,
                         "name": os.path.join(path, filename),
                     }
+            return_code = process.wait()
+            if return_code != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(
+                    return_code, cmd, stderr=stderr.read()
                 )
-
-        return files
-
-    def run(self, cmd_file, cp_pbar=True):
-        cmd = [self.binary_path, "run", cmd_file]
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            stderr.close()
+
+    def run(self, cmd_file, cp_pbar=True, numworkers=None, endpoint_args=()):
+        cmd = (
+            [self.binary_path]
+            + _numworkers_args(numworkers)
+            + list(endpoint_args)
+            + ["run", cmd_file]
+        )
         if cp_pbar:
-            f = open(cmd_file, "r")
-            # cmd_file.seek(0)
-            num_lines = sum(1 for _ in f if _.startswith("cp"))
+            with open(cmd_file, "r") as f:
+                num_lines = sum(1 for _ in f if _.startswith("cp"))
             pbar = tqdm(total=num_lines, unit="Files")
             inc_pbar = lambda line: pbar.update(int(line.startswith("cp")))
         else:
             inc_pbar = lambda line: None
 
         errs = []
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,  # text mode
-            bufsize=0,  # Unbuffered
-        )
 
-        set_non_blocking(process.stdout)
+        def on_line(line):
+            if not line.strip():
+                return
+            inc_pbar(line)
+            if line.startswith("ERROR "):
+                errs.append(line)
+            if cp_pbar and not line.strip().startswith("cp"):
+                print(line)
 
-        # Process output with poll/select mechanism
-        try:
-            running = True
-            poller = select.poll()
-            poller.register(process.stdout, select.POLLIN)
-            while running:
-                # Wait for data (100ms timeout)
-                if poller.poll(100):
-                    try:
-                        data = process.stdout.read()
-                        if not data:
-                            # End of stream
-                            if process.poll() is not None:
-                                running = False
-                                continue
-                        if not data.strip():
-                            continue
-
-                        inc_pbar(data)
-                        if data.startswith("ERROR "):
-                            errs.append(data)
-                        if (
-                            cp_pbar
-                            and data.strip()
-                            and not data.strip().startswith("cp")
-                        ):
-                            print(data)
-
-                    except io.BlockingIOError:
-                        # No data available right now
-                        pass
-                # Check if process has finished
-                if process.poll() is not None:
-                    running = False
+        self._stream_output(cmd, on_line)
 
-            # Wait for process to complete
-            return_code = process.wait()
+        return errs
 
-        except KeyboardInterrupt:
-            # Try to gracefully terminate the process
-            process.terminate()
-            try:
-                process.wait(timeout=2)
-            except subprocess.TimeoutExpired:
-                process.kill()
+    def iter_run(self, cmd_file, numworkers=None) -> Iterator[Dict]:
+        """
+        Like run, but yields s5cmd's per-operation JSON records (`--json`) as
+        each operation finishes, so callers can start on a downloaded file
+        while the rest of the run file is still in progress
 
-            if progress_bar:
-                progress_bar.finish()
+        Returns:
+            Iterator over records like {"operation": "cp", "success": true,
+            "source": ..., "destination": ...} (failed ones carry "error")
 
-            raise
-        finally:
-            # Make sure we clean up the process
-            if process.poll() is None:
+        Raises:
+            CalledProcessError: once all records are yielded, if s5cmd exited
+            non-zero (e.g. it died, or some operation failed)
+        """
+        cmd = (
+            [self.binary_path, "--json"]
+            + _numworkers_args(numworkers)
+            + ["run", cmd_file]
+        )
+        with self._spawn(cmd) as process:
+            for line in iter(process.stdout.readline, ""):
                 try:
-                    process.terminate()
-                    process.wait(timeout=2)
-                except (subprocess.TimeoutExpired, OSError):
-                    try:
-                        process.kill()
-                    except OSError:
-                        pass
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Anything s5cmd prints outside of --json (e.g. fatal errors)
+                    yield {"error": line.strip()}
+            return_code = process.wait()
+            if return_code != 0:
+                raise subprocess.CalledProcessError(return_code, cmd)
 
-        return errs
+
+# =====================================================
+# =               NATIVE (BOTO3) TRANSFERS            =
+# =====================================================
+
+MB = 1024 * 1024
+
+
+def _split_s3_uri(uri: str) -> Tuple[str, str]:
+    bucket, _, key = uri[len("s3://") :].partition("/")
+    return bucket, key
+
+
+def _s3_client(max_pool_connections: int):
+    return boto3.client(
+        "s3",
+        config=BotoConfig(
+            max_pool_connections=max_pool_connections,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+        ),
+    )
+
+
+def native_ls(path: str, workers: int = 32) -> Iterator[Dict]:
+    """
+    List s3:// objects with boto3, fanning out over CommonPrefixes: each
+    "directory" level is listed with Delimiter="/" and every subprefix found is
+    listed in parallel, instead of paging through one sequential ListObjectsV2
+
+    Args:
+        path: s3:// path. Wildcards match like s5cmd's (`*` also matches `/`),
+              so `s3://bucket/prefix/*` lists everything under prefix
+        workers: Number of concurrent ListObjectsV2 calls
+
+    Returns:
+        Iterator over objects, in the same format as S5CMD.ls
+    """
+    wildcard = min((i for i, c in enumerate(path) if c in "*?"), default=None)
+    bucket, prefix = _split_s3_uri(path[:wildcard])
+    pattern = path.replace("[", "[[]")  # s5cmd has no character classes
+    s3 = _s3_client(workers)
+
+    def list_level(level_prefix):
+        objects, subprefixes = [], []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=bucket, Prefix=level_prefix, Delimiter="/"
+        ):
+            objects.extend(page.get("Contents", []))
+            subprefixes.extend(_["Prefix"] for _ in page.get("CommonPrefixes", []))
+        return objects, subprefixes
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(list_level, prefix)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                objects, subprefixes = future.result()
+                # Without a wildcard, only list the top level (like s5cmd ls)
+                if wildcard is not None:
+                    for subprefix in subprefixes:
+                        pending.add(executor.submit(list_level, subprefix))
+                for obj in objects:
+                    name = "s3://%s/%s" % (bucket, obj["Key"])
+                    if wildcard is not None and not fnmatch.fnmatchcase(name, pattern):
+                        continue
+                    yield {
+                        "ts": obj["LastModified"].strftime("%Y-%m-%dT%H:%M:%S"),
+                        "size": obj["Size"],
+                        "name": name,
+                    }
+
+
+def native_download(
+    uris: Iterable[str],
+    dst: str,
+    numworkers: int = 64,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    part_size: int = DEFAULT_PART_SIZE,
+    transfer_client: str = "classic",
+) -> List[str]:
+    """
+    Download s3:// objects into the local directory dst in-process, using
+    boto3's transfer manager (multipart, pooled HTTP connections) instead of
+    shelling out to s5cmd
+
+    Args:
+        uris: s3:// paths of the objects to download
+        dst: Local destination directory (objects keep their basename, like
+             `cp <uri> <dst>` lines in an s5cmd run file)
+        numworkers: Number of objects in flight at once
+        concurrency: Byte-range GETs in flight per object
+        part_size: Size (in MB) of each byte range. Objects smaller than this are
+                   fetched with a single GET
+        transfer_client: "classic" for boto3's Python transfer manager, or "crt"
+                         for the AWS Common Runtime client (needs awscrt)
+
+    Returns:
+        List of error strings, one per failed object
+    """
+    # The transfer manager splits objects above the threshold into ranged GETs
+    # and writes them into the destination file as they arrive
+    transfer_config = TransferConfig(
+        multipart_threshold=part_size * MB,
+        multipart_chunksize=part_size * MB,
+        max_concurrency=concurrency,
+        preferred_transfer_client=transfer_client,
+    )
+    s3 = _s3_client(numworkers * concurrency)
+    os.makedirs(dst, exist_ok=True)
+
+    # Boto3Error covers RetriesExceededError; one bad object mustn't abort the
+    # other transfers
+    transfer_errors = (BotoCoreError, ClientError, Boto3Error, OSError)
+    if transfer_client == "crt" and importlib.util.find_spec("awscrt") is not None:
+        # The CRT client surfaces network/connection failures as AwsCrtError
+        from awscrt.exceptions import AwsCrtError
+
+        transfer_errors += (AwsCrtError,)
+
+    def fetch(uri):
+        bucket, key = _split_s3_uri(uri)
+        try:
+            s3.download_file(
+                bucket,
+                key,
+                os.path.join(dst, os.path.basename(key)),
+                Config=transfer_config,
+            )
+        except transfer_errors as err:
+            return "ERROR %s: %s" % (uri, err)
+
+    # Keep a bounded window of futures so the listing is never fully materialized
+    errs = []
+    pbar = tqdm(unit="Files")
+
+    def collect(done):
+        for future in done:
+            pbar.update(1)
+            if future.result() is not None:
+                errs.append(future.result())
+
+    with ThreadPoolExecutor(max_workers=numworkers) as executor:
+        in_flight = set()
+        for uri in uris:
+            if len(in_flight) >= 2 * numworkers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(fetch, uri))
+        collect(wait(in_flight)[0])
+    pbar.close()
+
+    for err in errs:
+        print(err)
+    return errs
 
 
 # =========================================================
@@ -360,12 +539,333 @@ class S5CMD:
 # =========================================================
 
 
+MANIFEST_HEADER = "# src: %s"
+
+
+def _open_manifest(manifest, mode, path=None):
+    # path overrides the file actually opened; the codec follows manifest's suffix
+    opener = gzip.open if manifest.endswith(".gz") else open
+    return opener(path or manifest, mode)
+
+
+def _external_sorted(keys: Iterable[str], num_runs: int = 64) -> Iterator[str]:
+    """
+    Sort a stream of keys without holding all of them in memory: keys are
+    hashed into num_runs temp files, each run is sorted on its own, and the
+    sorted runs are k-way merged
+    """
+    with TemporaryDirectory() as tmpdir:
+        runs = [
+            open(os.path.join(tmpdir, "run_%02d" % i), "w+") for i in range(num_runs)
+        ]
+        try:
+            for key in keys:
+                runs[zlib.crc32(key.encode()) % num_runs].write(key + "\n")
+            for run in runs:
+                run.seek(0)
+                lines = sorted(run)
+                run.seek(0)
+                run.truncate()
+                run.writelines(lines)
+                run.seek(0)
+            for line in heapq.merge(*runs):
+                yield line.rstrip("\n")
+        finally:
+            for run in runs:
+                run.close()
+
+
+LISTING_CACHE = os.path.expanduser("~/.cache/datamap/s3_listings.sqlite")
+
+
+def _cached_listing(
+    listing: Callable[[], Iterable[Dict]], src: str, ttl: int
+) -> Iterator[Dict]:
+    """
+    Objects under src from the local SQLite listing cache, refreshed with
+    listing() when the cached copy is older than ttl seconds (or missing)
+    """
+    os.makedirs(os.path.dirname(LISTING_CACHE), exist_ok=True)
+    # Autocommit mode, so the refresh transaction below is managed explicitly
+    conn = sqlite3.connect(LISTING_CACHE, timeout=3600, isolation_level=None)
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS listings (src TEXT, key TEXT, size INTEGER, "
+            "mtime TEXT, listed_at INTEGER, PRIMARY KEY (src, key))"
+        )
+        # Take the write lock before checking: parts started together wait for
+        # the first one to refresh instead of all re-listing the bucket
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = int(time.time())
+            (fresh,) = conn.execute(
+                "SELECT COUNT(*) FROM listings WHERE src = ? AND listed_at > ?",
+                (src, now - ttl),
+            ).fetchone()
+            if not fresh:
+                conn.execute("DELETE FROM listings WHERE src = ?", (src,))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)",
+                    ((src, _["name"], _["size"], _["ts"], now) for _ in listing()),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        rows = conn.execute(
+            "SELECT key, size, mtime FROM listings WHERE src = ?", (src,)
+        )
+        for key, size, mtime in rows:
+            yield {"ts": mtime, "size": size, "name": key}
+    finally:
+        conn.close()
+
+
+def _iter_objects(s5, src, list_workers=0, cache_ttl=0) -> Iterator[Dict]:
+    """
+    Objects under src (as returned by S5CMD.ls), in listing order. With
+    list_workers > 0 the bucket is listed with native_ls instead of `s5cmd ls`;
+    with cache_ttl > 0 listings younger than cache_ttl seconds are served from
+    the local listing cache.
+    """
+
+    def listing():
+        if list_workers > 0:
+            return native_ls(src, workers=list_workers)
+        return s5.iter_ls(src)
+
+    if cache_ttl > 0:
+        return _cached_listing(listing, src, cache_ttl)
+    return listing()
+
+
+def _iter_listing(s5, src, **listing_args) -> Iterator[str]:
+    """Keys under src, in listing order"""
+    for obj in _iter_objects(s5, src, **listing_args):
+        yield obj["name"]
+
+
+def _read_manifest(manifest, src) -> Iterator[str]:
+    """Keys stored in manifest, after checking it was written for src"""
+    with _open_manifest(manifest, "rt") as f:
+        header = f.readline().rstrip("\n")
+        if header != MANIFEST_HEADER % src:
+            raise ValueError(
+                "Manifest %s was not written for %s (header: %r)"
+                % (manifest, src, header)
+            )
+        for line in f:
+            if line.strip():
+                yield line.rstrip("\n")
+
+
+def _sorted_listing(s5, src, manifest=None, **listing_args) -> Iterator[str]:
+    """
+    Sorted keys under src. If a manifest path is given, the listing is read
+    from it when it exists, and otherwise written to it, so the parts of a
+    multi-part download only walk the bucket once.
+    """
+    listing = _iter_listing(s5, src, **listing_args)
+    if manifest is None:
+        yield from _external_sorted(listing)
+        return
+
+    # Hold an exclusive lock across the check and the write: parts started
+    # together wait for the first one to list instead of all walking the bucket
+    with open(manifest + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(manifest):
+            # Write-then-rename, so an interrupted listing never leaves a
+            # truncated manifest behind
+            tmp = "%s.%s.tmp" % (manifest, os.getpid())
+            try:
+                with _open_manifest(manifest, "wt", path=tmp) as f:
+                    f.write(MANIFEST_HEADER % src + "\n")
+                    for key in _external_sorted(listing):
+                        f.write(key + "\n")
+                os.replace(tmp, manifest)
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+
+    yield from _read_manifest(manifest, src)
+
+
+def _part_files(
+    s5, src, part, num_parts, manifest=None, partition="sorted", **listing_args
+) -> Iterator[str]:
+    """
+    Keys under src that belong to this part. "sorted" takes every num_parts-th
+    key of the sorted listing; "hash" keeps keys whose crc32 lands on this
+    part, so the listing is consumed as it streams in and never sorted
+    """
+    if partition == "hash":
+        if manifest is not None:
+            keys = _sorted_listing(s5, src, manifest, **listing_args)
+        else:
+            keys = _iter_listing(s5, src, **listing_args)
+        for key in keys:
+            if zlib.crc32(key.encode()) % num_parts == part:
+                yield key
+    else:
+        yield from itertools.islice(
+            _sorted_listing(s5, src, manifest, **listing_args), part, None, num_parts
+        )
+
+
+def _format_size(num_bytes: int) -> str:
+    size = float(num_bytes)
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1024:
+            return "%.2f %s" % (size, unit)
+        size /= 1024
+    return "%.2f PB" % size
+
+
+def _print_part_table(counts: List[int], sizes: Optional[List[int]], part: int):
+    # sizes is None when the plan came from a manifest (keys only)
+    fmt = lambda size: "n/a" if sizes is None else _format_size(size)
+    print("%6s %12s %12s" % ("part", "files", "size"))
+    for i, count in enumerate(counts):
+        marker = " <- this part" if i == part and len(counts) > 1 else ""
+        print("%6d %12d %12s%s" % (i, count, fmt(sizes and sizes[i]), marker))
+    print("%6s %12d %12s" % ("total", sum(counts), fmt(sizes and sum(sizes))))
+
+
+def _plan_download(
+    s5, src, num_parts, manifest=None, partition="sorted", **listing_args
+) -> Tuple[List[int], Optional[List[int]]]:
+    """
+    Number of files and bytes each part of a download would get, using the
+    same assignment as _part_files. An existing manifest is read instead of
+    listing the bucket; it has no sizes, so those come back as None
+    """
+    counts, sizes = [0] * num_parts, [0] * num_parts
+    if manifest is not None and os.path.exists(manifest):
+        for i, key in enumerate(_read_manifest(manifest, src)):
+            if partition == "hash":
+                i = zlib.crc32(key.encode())
+            counts[i % num_parts] += 1
+        return counts, None
+
+    objects = _iter_objects(s5, src, **listing_args)
+    if partition == "hash":
+        assigned = (
+            (zlib.crc32(_["name"].encode()) % num_parts, _["size"]) for _ in objects
+        )
+    else:
+        # Rank in sorted order decides the part; "\t" sorts before any key char
+        lines = _external_sorted("%s\t%d" % (_["name"], _["size"]) for _ in objects)
+        assigned = (
+            (i % num_parts, int(line.rsplit("\t", 1)[1]))
+            for i, line in enumerate(lines)
+        )
+    for i, size in assigned:
+        counts[i] += 1
+        sizes[i] += size
+    return counts, sizes
+
+
+def _local_size(path: str) -> int:
+    total = 0
+    for match in glob.glob(path) or [path]:
+        if os.path.isdir(match):
+            for root, _, names in os.walk(match):
+                total += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+        elif os.path.isfile(match):
+            total += os.path.getsize(match)
+    return total
+
+
+@contextmanager
+def _cp_script(
+    srcs: Iterable[str],
+    dst: str,
+    concurrency: Optional[int] = None,
+    part_size: Optional[int] = None,
+):
+    """
+    Write an `s5cmd run` file copying every src to dst and yield its path. The
+    file is closed before s5cmd gets to read it, and removed on exit even if
+    the run fails
+    """
+    prefix = " ".join(["cp"] + _multipart_args(concurrency, part_size)) + " "
+    suffix = " %s\n" % dst
+    fd, path = mkstemp(prefix="s5cmd-", suffix=".txt", text=True)
+    try:
+        with open(fd, "w", buffering=1 << 20) as f:
+            # Batched writelines: one call per 64K lines instead of one per key
+            srcs = iter(srcs)
+            while True:
+                batch = [prefix + _ + suffix for _ in itertools.islice(srcs, 1 << 16)]
+                if not batch:
+                    break
+                f.writelines(batch)
+        yield path
+    finally:
+        os.unlink(path)
+
+
+def _run_cp_script(
+    s5,
+    srcs: Iterable[str],
+    dst: str,
+    numworkers: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    part_size: Optional[int] = None,
+    endpoint_args: Iterable[str] = (),
+) -> List[str]:
+    """Copy every src to dst with a single `s5cmd run` invocation"""
+    with _cp_script(srcs, dst, concurrency, part_size) as cmd_file:
+        return s5.run(
+            cmd_file, cp_pbar=True, numworkers=numworkers, endpoint_args=endpoint_args
+        )
+
+
 @cli.command()
 @click.option("--src", required=True)
 @click.option("--dst", required=True)
 @click.option("--part", type=int, default=0)
 @click.option("--num-parts", type=int, default=1)
-def download(src, dst, part, num_parts):
+@click.option("--manifest", required=False, help="Listing cache (.txt or .txt.gz)")
+@click.option(
+    "--engine", type=click.Choice(["s5cmd", "native", "crt"]), default="s5cmd"
+)
+@click.option("--list-workers", type=int, default=0, help="List with boto3 (>0)")
+@click.option("--partition", type=click.Choice(["sorted", "hash"]), default="sorted")
+@click.option("--listing-cache-ttl", type=int, default=0, help="Seconds (0: off)")
+@click.option(
+    "--numworkers", type=int, help="Objects in flight [s5cmd: 256, native: 64]"
+)
+@click.option(
+    "--concurrency",
+    type=int,
+    default=DEFAULT_CONCURRENCY,
+    help="Parallel parts per object",
+)
+@click.option(
+    "--part-size",
+    type=int,
+    default=DEFAULT_PART_SIZE,
+    help="Multipart chunk size (MB)",
+)
+@click.option("--dry-run", is_flag=True, help="Print the plan, don't download")
+def download(
+    src,
+    dst,
+    part,
+    num_parts,
+    manifest,
+    engine,
+    list_workers,
+    partition,
+    listing_cache_ttl,
+    numworkers,
+    concurrency,
+    part_size,
+    dry_run,
+):
     assert part < num_parts
     assert not any(
         "weka://" in _ for _ in [src, dst]
@@ -375,30 +875,187 @@ def download(src, dst, part, num_parts):
     ), "GS stuff should be manually handled!"
 
     s5 = S5CMD()
-    if num_parts == 1:
+    s5_args = dict(
+        numworkers=numworkers or 256, concurrency=concurrency, part_size=part_size
+    )
+    listing_args = dict(list_workers=list_workers, cache_ttl=listing_cache_ttl)
+    if engine == "crt" and importlib.util.find_spec("awscrt") is None:
+        print("awscrt is not installed (pip install awscrt), using the native engine")
+        engine = "native"
+
+    if dry_run:
+        if engine in ("native", "crt"):
+            print(
+                "engine: %s, numworkers=%s concurrency=%s part_size=%sMB"
+                % (engine, numworkers or 64, concurrency, part_size)
+            )
+        elif num_parts == 1:
+            s5.cp(src, dst, dry_run=True, **s5_args)
+        else:
+            run_cmd = [s5.binary_path] + _numworkers_args(s5_args["numworkers"])
+            print("command:", shlex.join(run_cmd + ["run", "<run file>"]))
+            cp = ["cp"] + _multipart_args(concurrency, part_size)
+            print("run file lines:", shlex.join(cp + ["<key>", dst]))
+        if manifest and os.path.exists(manifest):
+            print("keys would be read from manifest:", manifest)
+        counts, sizes = _plan_download(
+            s5, src, num_parts, manifest, partition, **listing_args
+        )
+        _print_part_table(counts, sizes, part)
+        return
+
+    if engine in ("native", "crt"):
+        files_to_download = _part_files(
+            s5, src, part, num_parts, manifest, partition, **listing_args
+        )
+        native_download(
+            files_to_download,
+            dst,
+            numworkers=numworkers or 64,
+            concurrency=concurrency,
+            part_size=part_size,
+            transfer_client="crt" if engine == "crt" else "classic",
+        )
+    elif num_parts == 1:
         # Just run the `s5cmd cp command directly`
-        s5.cp(src, dst)
+        s5.cp(src, dst, **s5_args)
     else:
         # Create a text file to run `s5cmd run ...` on
 
-        # So first get the list of files and sort them
-        s3_files = [_["name"] for _ in s5.ls(src)]
-        files_to_download = sorted(s3_files)[part::num_parts]
-        # Then create a temp file with the files to download
-        f = NamedTemporaryFile("w")
-        for filename in files_to_download:
-            f.write("cp %s %s\n" % (filename, dst))
-        f.flush()
-        s5.run(f.name, cp_pbar=True)
+        # So first get the list of files in this part
+        files_to_download = _part_files(
+            s5, src, part, num_parts, manifest, partition, **listing_args
+        )
+        # Then run them all from one `s5cmd run` file
+        _run_cp_script(s5, files_to_download, dst, **s5_args)
 
 
 @cli.command()
 @click.option("--src", required=True)
-@click.option("--dst", required=False)
-def upload(src, dst):
+@click.option("--dst", required=True)
+@click.option("--part", type=int, default=0)
+@click.option("--num-parts", type=int, default=1)
+@click.option("--manifest", required=False, help="Listing cache (.txt or .txt.gz)")
+@click.option("--list-workers", type=int, default=0, help="List with boto3 (>0)")
+@click.option("--partition", type=click.Choice(["sorted", "hash"]), default="sorted")
+@click.option("--listing-cache-ttl", type=int, default=0, help="Seconds (0: off)")
+@click.option("--numworkers", type=int, default=256, help="Objects in flight")
+@click.option(
+    "--concurrency",
+    type=int,
+    default=DEFAULT_CONCURRENCY,
+    help="Parallel parts per object",
+)
+@click.option(
+    "--part-size",
+    type=int,
+    default=DEFAULT_PART_SIZE,
+    help="Multipart chunk size (MB)",
+)
+def download_stream(
+    src,
+    dst,
+    part,
+    num_parts,
+    manifest,
+    list_workers,
+    partition,
+    listing_cache_ttl,
+    numworkers,
+    concurrency,
+    part_size,
+):
+    """
+    Same selection as download (s5cmd engine), but prints each local path to
+    stdout as soon as its file has landed, so a downstream consumer reading
+    the pipe can start processing while the rest is still downloading. Exits
+    non-zero if any copy failed or s5cmd itself did, so the consumer can tell
+    a partial run from a complete one
+    """
+    assert part < num_parts
+    assert not any(
+        "weka://" in _ for _ in [src, dst]
+    ), "Weka stuff should be manually handled!"
+    assert not any(
+        "gs://" in _ for _ in [src, dst]
+    ), "GS stuff should be manually handled!"
+
+    s5 = S5CMD()
+    listing_args = dict(list_workers=list_workers, cache_ttl=listing_cache_ttl)
+    files_to_download = _part_files(
+        s5, src, part, num_parts, manifest, partition, **listing_args
+    )
+    failed, return_code = 0, 0
+    with _cp_script(files_to_download, dst, concurrency, part_size) as cmd_file:
+        try:
+            for record in s5.iter_run(cmd_file, numworkers=numworkers):
+                if record.get("success"):
+                    print(record["destination"], flush=True)
+                elif "error" in record:
+                    failed += 1
+                    print("ERROR", record["error"], file=sys.stderr)
+        except subprocess.CalledProcessError as err:
+            return_code = err.returncode
+
+    if failed or return_code:
+        print(
+            "ERROR %d failed copies, s5cmd exited with %d" % (failed, return_code),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+@cli.command()
+@click.option("--src", required=False, multiple=True)
+@click.option("--dst", required=True, help="Prefix when uploading several sources")
+@click.option("--manifest", required=False, help="File with one src path per line")
+@click.option("--numworkers", type=int, default=256, help="Objects in flight")
+@click.option(
+    "--concurrency",
+    type=int,
+    default=DEFAULT_CONCURRENCY,
+    help="Parallel parts per object",
+)
+@click.option(
+    "--part-size",
+    type=int,
+    default=DEFAULT_PART_SIZE,
+    help="Multipart chunk size (MB)",
+)
+@click.option("--dry-run", is_flag=True, help="Print the plan, don't upload")
+def upload(src, dst, manifest, numworkers, concurrency, part_size, dry_run):
     # Is literally just an s5cmd wrapper for uploading
+    srcs = list(src)
+    if manifest:
+        with open(manifest, "r") as f:
+            srcs.extend(line.strip() for line in f if line.strip())
+    assert srcs, "Need at least one --src (or a --manifest)"
+
     s5 = S5CMD()
-    s5.cp(src, dst)
+    s5_args = dict(numworkers=numworkers, concurrency=concurrency, part_size=part_size)
+    if len(srcs) > 1:
+        # Every run-file line gets the same dst, so it has to be a prefix
+        if not dst.endswith("/"):
+            dst += "/"
+        dst, endpoint_args = _remote_endpoint(dst)
+
+    if dry_run:
+        if len(srcs) == 1:
+            s5.cp(srcs[0], dst, dry_run=True, **s5_args)
+        else:
+            run_cmd = [s5.binary_path] + _numworkers_args(numworkers) + endpoint_args
+            print("command:", shlex.join(run_cmd + ["run", "<run file>"]))
+            cp = ["cp"] + _multipart_args(concurrency, part_size)
+            print("run file lines:", shlex.join(cp + ["<src>", dst]))
+        total = sum(_local_size(_) for _ in srcs)
+        print("sources: %d, total size: %s" % (len(srcs), _format_size(total)))
+        return
+
+    if len(srcs) == 1:
+        s5.cp(srcs[0], dst, **s5_args)
+    else:
+        # One s5cmd process (and AWS session) for all files, not one per file
+        _run_cp_script(s5, srcs, dst, endpoint_args=endpoint_args, **s5_args)
 
 
 if __name__ == "__main__":